@@ -0,0 +1,388 @@
+"""Key agent that keeps derived deck keys in memory across invocations.
+
+Similar to ssh-agent, the agent listens on a Unix socket that only the
+current user can access. Clients find it through the
+:data:`AGENT_SOCKET_ENV` environment variable.
+
+Usage::
+
+    eval "$(python agent.py start [--socket PATH] [--ttl SECONDS])"
+    python agent.py forget DECK_PATH
+    python agent.py lock
+    kill $PASSWORD_TRAINER_AGENT_PID
+
+``start`` detaches and prints shell commands that export the socket path
+and process ID. With ``--foreground`` it keeps running in the terminal
+instead, e.g. ``python agent.py start --foreground &``.
+"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import socket
+import signal
+import socketserver
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+from typing import Optional, TypedDict
+
+AGENT_SOCKET_ENV = "PASSWORD_TRAINER_AGENT_SOCK"
+"""Environment variable holding the path of the agent socket"""
+
+DEFAULT_KEY_TTL = 15 * 60
+"""Default number of seconds a key is kept by the agent"""
+
+AGENT_PID_ENV = "PASSWORD_TRAINER_AGENT_PID"
+"""Environment variable holding the process ID of a detached agent"""
+
+_CLIENT_TIMEOUT = 2
+
+l = logging.getLogger(__name__)
+
+
+class AgentRequest(TypedDict, total=False):
+    command: str
+    """One of `get`, `put`, `forget` or `lock`"""
+    deck_path: str
+    salt: str
+    iterations: int
+    key: str
+    """Derived key encoded in base64"""
+
+
+class AgentResponse(TypedDict, total=False):
+    ok: bool
+    key: Optional[str]
+    error: str
+
+
+class AgentError(Exception):
+    pass
+
+
+class KeyAgentServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server holding derived keys per (deck path, salt, iterations).
+    Each connection is handled in its own thread, so a slow client
+    does not block the others.
+    """
+
+    daemon_threads = True
+
+    ttl: float
+    _keys: dict[tuple[str, str, int], tuple[bytes, float]]
+    _lock: threading.Lock
+
+    def __init__(self, socket_path: str, ttl: float = DEFAULT_KEY_TTL):
+        self.ttl = ttl
+        self._keys = {}
+        self._lock = threading.Lock()
+
+        # Only the owner may connect to the socket
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, KeyAgentRequestHandler)
+        finally:
+            os.umask(old_umask)
+        os.chmod(socket_path, 0o600)
+
+    def verify_request(self, request: socket.socket, client_address) -> bool:
+        """Reject connections from other users, in case the socket permissions
+        are not enforced (e.g. the socket was moved to a shared directory).
+        """
+        creds = request.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+        )
+        _, uid, _ = struct.unpack("3i", creds)
+        if uid != os.getuid():
+            l.warning("Rejected connection from uid %s", uid)
+            return False
+        return True
+
+    def service_actions(self):
+        self.purge_expired_keys()
+
+    def purge_expired_keys(self):
+        now = time.monotonic()
+        with self._lock:
+            for key_id in [k for k, (_, exp) in self._keys.items() if exp <= now]:
+                l.info("Key of deck `%s` expired", key_id[0])
+                del self._keys[key_id]
+
+    def get_key(self, key_id: tuple[str, str, int]) -> Optional[bytes]:
+        with self._lock:
+            item = self._keys.get(key_id)
+        if item is None or item[1] <= time.monotonic():
+            return None
+        return item[0]
+
+    def put_key(self, key_id: tuple[str, str, int], key: bytes):
+        with self._lock:
+            self._keys[key_id] = (key, time.monotonic() + self.ttl)
+
+    def forget_keys(self, deck_path: Optional[str] = None):
+        """Forget the keys of a deck, or every key if `deck_path` is None"""
+        with self._lock:
+            if deck_path is None:
+                l.info("Forget all keys")
+                self._keys.clear()
+                return
+            l.info("Forget keys of deck `%s`", deck_path)
+            for key_id in [k for k in self._keys if k[0] == deck_path]:
+                del self._keys[key_id]
+
+
+class KeyAgentRequestHandler(socketserver.StreamRequestHandler):
+    server: KeyAgentServer
+    timeout = _CLIENT_TIMEOUT
+
+    def handle(self):
+        try:
+            request: AgentRequest = json.loads(self.rfile.readline())
+            response = self._dispatch(request)
+        except TimeoutError:
+            l.warning("Client did not send a request in time")
+            return
+        except (ValueError, KeyError, TypeError) as e:
+            response = {"ok": False, "error": "Invalid request: {}".format(e)}
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+    def _dispatch(self, request: AgentRequest) -> AgentResponse:
+        match request["command"]:
+            case "get":
+                key = self.server.get_key(_key_id(request))
+                return {
+                    "ok": True,
+                    "key": base64.b64encode(key).decode("ascii") if key else None,
+                }
+            case "put":
+                key = base64.b64decode(request["key"])
+                self.server.put_key(_key_id(request), key)
+                return {"ok": True}
+            case "forget":
+                self.server.forget_keys(request["deck_path"])
+                return {"ok": True}
+            case "lock":
+                self.server.forget_keys()
+                return {"ok": True}
+        return {"ok": False, "error": "Unknown command `{}`".format(request["command"])}
+
+
+def _key_id(request: AgentRequest) -> tuple[str, str, int]:
+    return (request["deck_path"], request["salt"], int(request["iterations"]))
+
+
+def send_agent_request(
+    request: AgentRequest, socket_path: Optional[str] = None
+) -> AgentResponse:
+    """Send a request to the agent.
+
+    Parameters
+    ----------
+    request : AgentRequest
+        Request
+    socket_path : Optional[str], optional
+        Agent socket path, by default read from :data:`AGENT_SOCKET_ENV`
+
+    Returns
+    -------
+    AgentResponse
+        Response of the agent
+
+    Raises
+    ------
+    AgentError
+        If no agent is configured, it cannot be reached, or the request failed
+    """
+    socket_path = socket_path or os.environ.get(AGENT_SOCKET_ENV)
+    if not socket_path:
+        raise AgentError("No agent socket configured")
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(_CLIENT_TIMEOUT)
+            sock.connect(socket_path)
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as f:
+                response: AgentResponse = json.loads(f.readline())
+    except (OSError, ValueError) as e:
+        raise AgentError("Could not reach agent at `{}`: {}".format(socket_path, e))
+
+    if not response.get("ok"):
+        raise AgentError(response.get("error", "Agent request failed"))
+    return response
+
+
+def request_key(deck_path: str, salt: str, iterations: int) -> Optional[bytes]:
+    """Ask the agent for a derived deck key.
+
+    Returns
+    -------
+    Optional[bytes]
+        The key, or None if the agent is unavailable or does not hold it
+    """
+    if not os.environ.get(AGENT_SOCKET_ENV):
+        return None
+    try:
+        response = send_agent_request(
+            {
+                "command": "get",
+                "deck_path": os.path.abspath(deck_path),
+                "salt": salt,
+                "iterations": iterations,
+            }
+        )
+    except AgentError as e:
+        l.warning("Could not get key from agent: %s", e)
+        return None
+
+    if response.get("key") is None:
+        l.info("Agent has no key for deck `%s`", deck_path)
+        return None
+    l.info("Got key of deck `%s` from agent", deck_path)
+    return base64.b64decode(response["key"])
+
+
+def store_key(deck_path: str, salt: str, iterations: int, key: bytes):
+    """Give a derived deck key to the agent, if one is available."""
+    if not os.environ.get(AGENT_SOCKET_ENV):
+        return
+    try:
+        send_agent_request(
+            {
+                "command": "put",
+                "deck_path": os.path.abspath(deck_path),
+                "salt": salt,
+                "iterations": iterations,
+                "key": base64.b64encode(key).decode("ascii"),
+            }
+        )
+        l.info("Stored key of deck `%s` in agent", deck_path)
+    except AgentError as e:
+        l.warning("Could not store key in agent: %s", e)
+
+
+def remove_stale_socket(socket_path: str):
+    """Remove a socket file left behind by an agent that is no longer running.
+
+    Raises
+    ------
+    AgentError
+        If an agent is still listening, or the path is not a socket
+    """
+    if not os.path.exists(socket_path):
+        return
+    if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+        raise AgentError("`{}` exists and is not a socket".format(socket_path))
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except ConnectionRefusedError:
+            l.info("Remove stale socket `%s`", socket_path)
+            os.remove(socket_path)
+            return
+    raise AgentError("An agent is already listening on `{}`".format(socket_path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Password Trainer key agent")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    start_parser = subparsers.add_parser("start", help="Start the agent")
+    start_parser.add_argument("--socket", help="Socket path to listen on")
+    start_parser.add_argument(
+        "--ttl",
+        type=float,
+        default=DEFAULT_KEY_TTL,
+        help="Seconds a key is kept, by default %(default)s",
+    )
+    start_parser.add_argument(
+        "--foreground",
+        action="store_true",
+        help="Do not detach from the terminal",
+    )
+
+    forget_parser = subparsers.add_parser("forget", help="Forget the keys of a deck")
+    forget_parser.add_argument("deck_path")
+
+    subparsers.add_parser("lock", help="Forget every key")
+
+    args = parser.parse_args()
+    try:
+        match args.command:
+            case "start":
+                _start_agent(args.socket, args.ttl, args.foreground)
+            case "forget":
+                send_agent_request(
+                    {"command": "forget", "deck_path": os.path.abspath(args.deck_path)}
+                )
+            case "lock":
+                send_agent_request({"command": "lock"})
+    except AgentError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+
+def _start_agent(socket_path: Optional[str], ttl: float, foreground: bool):
+    socket_dir = None
+    if socket_path is None:
+        socket_dir = tempfile.mkdtemp(prefix="password-trainer-")
+        socket_path = os.path.join(socket_dir, "agent.sock")
+    else:
+        remove_stale_socket(socket_path)
+
+    # Bind before detaching, so the socket exists once the export line is read
+    server = KeyAgentServer(socket_path, ttl)
+    if not foreground:
+        pid = os.fork()
+        if pid:
+            print(
+                "{}={}; export {};".format(
+                    AGENT_SOCKET_ENV, socket_path, AGENT_SOCKET_ENV
+                )
+            )
+            print("{}={}; export {};".format(AGENT_PID_ENV, pid, AGENT_PID_ENV))
+            print("echo Agent pid {};".format(pid))
+            sys.stdout.flush()
+            os._exit(0)
+        _detach()
+    else:
+        print(
+            "{}={}; export {};".format(AGENT_SOCKET_ENV, socket_path, AGENT_SOCKET_ENV)
+        )
+        sys.stdout.flush()
+
+    # shutdown() blocks until serve_forever() returns, so it cannot be called
+    # from the signal handler running on the serving thread
+    signal.signal(
+        signal.SIGTERM,
+        lambda signum, frame: threading.Thread(target=server.shutdown).start(),
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        if socket_dir:
+            os.rmdir(socket_dir)
+
+
+def _detach():
+    """Detach the forked agent from the terminal and the calling shell"""
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    os.close(devnull)
+
+
+if __name__ == "__main__":
+    main()
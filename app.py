@@ -1,10 +1,17 @@
 import logging
 import os
 from glob import glob
-
-from deck import DeckContext, DeckInfo
+from typing import Callable, Optional
+
+from deck import (
+    DeckContext,
+    DeckDecryptionError,
+    DeckInfo,
+    UnsupportedDeckVersionError,
+    request_agent_deck_key,
+)
 from settings import Settings
-from utils import read_json_file, write_json_to_file
+from utils import InvalidJsonFileError, read_json_file, write_json_to_file
 
 DECK_FILE_SUFFIX = ".deck.json"
 """Extension or suffix for a deck file"""
@@ -17,7 +24,7 @@ class AppContext:
     _decks_dir_path: str
     _deck_infos: list[DeckInfo] = []
     _deck_context: DeckContext | None = None
-    _settings: Settings = {"hashing": {"algorithm": "scrypt"}}
+    _settings: Settings = {"hashing": {"algorithm": "scrypt"}, "identify": {}}
 
     def __init__(self, settings_path: str, decks_dir_path: str):
         self._settings_path = settings_path
@@ -69,7 +76,80 @@ class AppContext:
     def load_deck_from_info(self, deck_info: DeckInfo, password: str | None = None):
         l.info("Loading deck `%s` by DeckInfo", deck_info["name"])
         deck_data = read_json_file(deck_info["path"])
-        self.load_deck(DeckContext(deck_info["name"], deck_data, password))
+        self.load_deck(
+            DeckContext(deck_info["name"], deck_data, password, deck_info["path"])
+        )
+
+    def load_all_deck_contexts(
+        self,
+        get_password: Callable[[DeckInfo, bool], Optional[str]],
+        on_error: Optional[Callable[[DeckInfo, Exception], None]] = None,
+    ) -> list[DeckContext]:
+        """Load every deck in :attr:`AppContext._decks_dir_path`.
+        The currently loaded deck is reused instead of being read again.
+
+        Parameters
+        ----------
+        get_password : Callable[[DeckInfo, bool], Optional[str]]
+            Called for each encrypted deck to get its password, with True if
+            the previous password was wrong. Returning None skips the deck.
+        on_error : Optional[Callable[[DeckInfo, Exception], None]], optional
+            Called for each deck that is skipped because it cannot be read
+            (invalid JSON or unsupported format), by default None
+
+        Returns
+        -------
+        list[DeckContext]
+            Deck contexts of every deck that was not skipped
+        """
+        deck_contexts: list[DeckContext] = []
+        for deck_info in self._deck_infos:
+            if self._deck_context and self._deck_context.name == deck_info["name"]:
+                deck_contexts.append(self._deck_context)
+                continue
+
+            try:
+                deck_context = self._prompt_load_deck(deck_info, get_password)
+            except (InvalidJsonFileError, UnsupportedDeckVersionError) as e:
+                l.warning("Skip unreadable deck `%s`", deck_info["name"], exc_info=1)
+                if on_error:
+                    on_error(deck_info, e)
+                continue
+            if deck_context:
+                deck_contexts.append(deck_context)
+        return deck_contexts
+
+    def _prompt_load_deck(
+        self,
+        deck_info: DeckInfo,
+        get_password: Callable[[DeckInfo, bool], Optional[str]],
+    ) -> DeckContext | None:
+        """Load a deck, asking for its password again while it is wrong.
+        Returns None if the password is declined.
+        """
+        l.info("Loading deck `%s` by DeckInfo", deck_info["name"])
+        deck_data = read_json_file(deck_info["path"])
+        is_encrypted = deck_data["encryption"]["enabled"]
+        password = None
+        key = None
+        if is_encrypted:
+            key = request_agent_deck_key(deck_info["path"], deck_data["encryption"])
+
+        is_retry = False
+        while True:
+            if is_encrypted and key is None:
+                password = get_password(deck_info, is_retry)
+                if password is None:
+                    l.info("Skip deck `%s`", deck_info["name"])
+                    return None
+            try:
+                return DeckContext(
+                    deck_info["name"], deck_data, password, deck_info["path"], key
+                )
+            except DeckDecryptionError:
+                l.warning("Could not decrypt deck `%s`", deck_info["name"])
+                key = None
+                is_retry = True
 
     def get_settings(self) -> Settings:
         return self._settings
@@ -1,17 +1,47 @@
 import base64
 import os
 import logging
+import struct
 from typing import Optional, TypedDict
-from cryptography.fernet import Fernet
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
+from agent import request_key, store_key
 from settings import HashingSettings
 from utils import base64_str_to_bytes, bytes_to_base64_str
 
 
 l = logging.getLogger(__name__)
 
+DECK_ENCRYPTION_VERSION = 2
+"""Encryption format version used for new and upgraded decks.
+
+- Version 1 encrypts the prompt, hash and salt of each entry
+  as three separate Fernet tokens.
+- Version 2 serializes each entry into one binary record
+  encrypted with a single AES-GCM operation.
+"""
+
+_RECORD_HEADER = struct.Struct(">IHH")
+"""Lengths of the prompt, hash and salt in a version 2 entry record"""
+
+_NONCE_SIZE = 12
+
+
+class DeckDecryptionError(Exception):
+    """Raised when deck entries cannot be decrypted,
+    e.g. because of a wrong password.
+    """
+
+
+class UnsupportedDeckVersionError(Exception):
+    """Raised when a deck uses an encryption format version
+    this version of the app does not know.
+    """
+
 
 class DeckInfo(TypedDict):
     name: str
@@ -22,6 +52,8 @@ class DeckEncryptionSettings(TypedDict):
     enabled: bool
     salt: str
     iterations: int
+    version: int
+    """Encryption format version, treated as 1 if missing"""
 
 
 class DeckEntry(TypedDict):
@@ -33,7 +65,8 @@ class DeckEntry(TypedDict):
 
 
 class DeckData(TypedDict):
-    entries: list[DeckEntry]
+    entries: list[DeckEntry] | list[str]
+    """Deck entries, or base64 encoded records if encrypted with version 2"""
     encryption: DeckEncryptionSettings
     hashing: HashingSettings
 
@@ -43,44 +76,144 @@ class DeckContext:
     _entries: list[DeckEntry] = []
     _encryption: DeckEncryptionSettings
     _hashing: HashingSettings
-    _password: Optional[str]
+    _key: Optional[bytes] = None
+    _path: Optional[str]
 
     def __init__(
         self,
         name: str,
         deck_data: DeckData,
         password: Optional[str] = None,
+        path: Optional[str] = None,
+        key: Optional[bytes] = None,
     ):
+        """
+        Parameters
+        ----------
+        name : str
+            Deck name
+        deck_data : DeckData
+            Deck data (encrypted if encryption is enabled)
+        password : Optional[str], optional
+            Encryption password, not needed if the key is given
+            or held by the key agent, by default None
+        path : Optional[str], optional
+            Path of the deck file, used to look up the key agent, by default None
+        key : Optional[bytes], optional
+            Already derived encryption key, by default None
+        """
         self.name = name
-        self._password = password
+        self._path = path
         if "encryption" in deck_data:
             self._encryption = deck_data["encryption"]
         else:
             self._encryption = generate_deck_encryption_settings(False)
 
+        key_derived = False
+        if self._encryption["enabled"]:
+            self._key = key or self._request_agent_key()
+            if self._key is None:
+                self._key = self._derive_key(password)
+                key_derived = True
+
         if "entries" in deck_data:
             if self._encryption["enabled"]:
-                self._entries = decrypt_deck_entries(
-                    deck_data["entries"], self._encryption, password
-                )
+                try:
+                    self._entries = decrypt_deck_entries(
+                        deck_data["entries"], self._encryption, self._key
+                    )
+                except (InvalidToken, InvalidTag):
+                    raise DeckDecryptionError(
+                        "Could not decrypt deck `{}`, the password may be wrong".format(
+                            name
+                        )
+                    )
             else:
                 self._entries = deck_data["entries"]
         self._hashing = deck_data["hashing"]
 
+        # Only hand the key to the agent once it has decrypted the deck
+        if key_derived and path:
+            store_key(
+                path,
+                self._encryption["salt"],
+                self._encryption["iterations"],
+                self._key,
+            )
+
+    def _request_agent_key(self) -> Optional[bytes]:
+        if not self._path:
+            return None
+        return request_agent_deck_key(self._path, self._encryption)
+
+    def _derive_key(self, password: Optional[str]) -> bytes:
+        if password is None:
+            raise ValueError(
+                "A password is required to open deck `{}`".format(self.name)
+            )
+        salt = base64_str_to_bytes(self._encryption["salt"])
+        return derive_key(password, salt, self._encryption["iterations"])
+
     def get_entries(self) -> list[DeckEntry]:
         return self._entries
 
     def get_hashing(self) -> HashingSettings:
         return self._hashing
 
+    def get_key(self) -> Optional[bytes]:
+        """Encryption key, or None if encryption is not enabled"""
+        return self._key if self._encryption["enabled"] else None
+
     def append_entry(self, entry: DeckEntry):
         self._entries.append(entry)
 
     def remove_entry():
         pass
 
-    def set_entries():
-        pass
+    def is_encryption_outdated(self) -> bool:
+        return (
+            self._encryption["enabled"]
+            and get_encryption_version(self._encryption) < DECK_ENCRYPTION_VERSION
+        )
+
+    def upgrade_encryption(self, password: str):
+        """Upgrade the deck to the latest encryption format.
+        A new salt is generated so the new format does not reuse the key
+        of the old one. The new format is written the next time the deck is saved.
+
+        Parameters
+        ----------
+        password : str
+            Deck password
+
+        Raises
+        ------
+        DeckDecryptionError
+            If the password is wrong
+        """
+        old_salt = base64_str_to_bytes(self._encryption["salt"])
+        if derive_key(password, old_salt, self._encryption["iterations"]) != self._key:
+            raise DeckDecryptionError("Wrong password for deck `{}`".format(self.name))
+
+        l.info(
+            "Upgrade encryption of deck `%s` from version %s to %s",
+            self.name,
+            get_encryption_version(self._encryption),
+            DECK_ENCRYPTION_VERSION,
+        )
+        self._encryption = generate_deck_encryption_settings(True)
+        salt = base64_str_to_bytes(self._encryption["salt"])
+        self._key = derive_key(password, salt, self._encryption["iterations"])
+        if self._path:
+            store_key(
+                self._path,
+                self._encryption["salt"],
+                self._encryption["iterations"],
+                self._key,
+            )
+
+    def set_entries(self, entries: list[DeckEntry]):
+        self._entries = entries
 
     def generate_deck_data(self) -> DeckData:
         """Generate deck data (encrypted if encryption is enabled)
@@ -101,16 +234,223 @@ class DeckContext:
             return deck_data
 
         deck_data["entries"] = encrypt_deck_entries(
-            self._entries, self._encryption, self._password
+            self._entries, self._encryption, self._key
         )
 
         return deck_data
 
 
+def request_agent_deck_key(
+    path: str, encryption: DeckEncryptionSettings
+) -> Optional[bytes]:
+    """Ask the key agent for the key of the deck at `path`.
+
+    Returns
+    -------
+    Optional[bytes]
+        The key, or None if there is no agent or it does not hold the key
+    """
+    return request_key(path, encryption["salt"], encryption["iterations"])
+
+
+def get_encryption_version(encryption: DeckEncryptionSettings) -> int:
+    return encryption.get("version", 1)
+
+
+def _unsupported_version_error(
+    encryption: DeckEncryptionSettings,
+) -> UnsupportedDeckVersionError:
+    return UnsupportedDeckVersionError(
+        "Deck encryption format version {} is not supported "
+        "(supported versions are 1 to {})".format(
+            get_encryption_version(encryption), DECK_ENCRYPTION_VERSION
+        )
+    )
+
+
 def encrypt_deck_entries(
-    entries: list[DeckEntry], encryption: DeckEncryptionSettings, password: str
+    entries: list[DeckEntry], encryption: DeckEncryptionSettings, key: bytes
+) -> list[DeckEntry] | list[str]:
+    """Encrypt deck entries using the format version in the encryption settings.
+    Does not mutate original list of entries.
+
+    Parameters
+    ----------
+    entries : list[DeckEntry]
+        List of unencrypted deck entries
+    encryption : DeckEncryptionSettings
+        Deck encryption settings
+    key : bytes
+        Key derived with :func:`derive_key`
+
+    Returns
+    -------
+    list[DeckEntry] | list[str]
+        Encrypted deck entries
+    """
+    match get_encryption_version(encryption):
+        case 1:
+            return encrypt_deck_entries_v1(entries, encryption, key)
+        case 2:
+            return encrypt_deck_entries_v2(entries, encryption, key)
+    raise _unsupported_version_error(encryption)
+
+
+def decrypt_deck_entries(
+    entries: list[DeckEntry] | list[str],
+    encryption: DeckEncryptionSettings,
+    key: bytes,
+) -> list[DeckEntry]:
+    """Decrypt deck entries using the format version in the encryption settings.
+
+    Parameters
+    ----------
+    entries : list[DeckEntry] | list[str]
+        List of encrypted deck entries
+    encryption : DeckEncryptionSettings
+        Deck encryption settings
+    key : bytes
+        Key derived with :func:`derive_key`
+
+    Returns
+    -------
+    list[DeckEntry]
+        List of unencrypted deck entries
+    """
+    match get_encryption_version(encryption):
+        case 1:
+            return decrypt_deck_entries_v1(entries, encryption, key)
+        case 2:
+            return decrypt_deck_entries_v2(entries, encryption, key)
+    raise _unsupported_version_error(encryption)
+
+
+def encrypt_deck_entries_v2(
+    entries: list[DeckEntry], encryption: DeckEncryptionSettings, key: bytes
+) -> list[str]:
+    """Encrypt deck entries into version 2 records.
+
+    Each entry is packed into one binary record and encrypted with AES-GCM.
+    The entry index and the number of entries are bound as associated data,
+    so records cannot be reordered, removed or truncated without failing
+    authentication.
+
+    Parameters
+    ----------
+    entries : list[DeckEntry]
+        List of unencrypted deck entries
+    encryption : DeckEncryptionSettings
+        Deck encryption settings
+    key : bytes
+        Key derived with :func:`derive_key`
+
+    Returns
+    -------
+    list[str]
+        Base64 encoded nonce and ciphertext of each entry
+    """
+    aesgcm = AESGCM(key)
+
+    encrypted_entries: list[str] = []
+    for i, entry in enumerate(entries):
+        l.debug("Encrypt entry of index %s", i)
+        nonce = os.urandom(_NONCE_SIZE)
+        aad = _entry_aad(i, len(entries))
+        ciphertext = aesgcm.encrypt(nonce, pack_deck_entry(entry), aad)
+        encrypted_entries.append(base64.b64encode(nonce + ciphertext).decode("ascii"))
+    return encrypted_entries
+
+
+def decrypt_deck_entries_v2(
+    entries: list[str], encryption: DeckEncryptionSettings, key: bytes
+) -> list[DeckEntry]:
+    """Decrypt version 2 deck entry records.
+
+    Parameters
+    ----------
+    entries : list[str]
+        Base64 encoded nonce and ciphertext of each entry
+    encryption : DeckEncryptionSettings
+        Deck encryption settings
+    key : bytes
+        Key derived with :func:`derive_key`
+
+    Returns
+    -------
+    list[DeckEntry]
+        List of unencrypted deck entries
+    """
+    aesgcm = AESGCM(key)
+
+    decrypted_entries: list[DeckEntry] = []
+    for i, record in enumerate(entries):
+        l.debug("Decrypt entry of index %s", i)
+        raw = base64.b64decode(record)
+        nonce, ciphertext = raw[:_NONCE_SIZE], raw[_NONCE_SIZE:]
+        aad = _entry_aad(i, len(entries))
+        decrypted_entries.append(
+            unpack_deck_entry(aesgcm.decrypt(nonce, ciphertext, aad))
+        )
+    return decrypted_entries
+
+
+def pack_deck_entry(entry: DeckEntry) -> bytes:
+    """Serialize a deck entry into a compact binary record.
+
+    Parameters
+    ----------
+    entry : DeckEntry
+        Unencrypted deck entry
+
+    Returns
+    -------
+    bytes
+        Lengths header followed by the prompt, hash and salt
+    """
+    prompt = entry["prompt"].encode("utf-8")
+    data = base64_str_to_bytes(entry["data"])
+    salt = base64_str_to_bytes(entry["salt"])
+    header = _RECORD_HEADER.pack(len(prompt), len(data), len(salt))
+    return header + prompt + data + salt
+
+
+def unpack_deck_entry(record: bytes) -> DeckEntry:
+    """Deserialize a binary record created by :func:`pack_deck_entry`.
+
+    Parameters
+    ----------
+    record : bytes
+        Binary record
+
+    Returns
+    -------
+    DeckEntry
+        Deck entry
+    """
+    prompt_len, data_len, salt_len = _RECORD_HEADER.unpack_from(record)
+    start = _RECORD_HEADER.size
+    prompt = record[start : start + prompt_len]
+    start += prompt_len
+    data = record[start : start + data_len]
+    start += data_len
+    salt = record[start : start + salt_len]
+    return {
+        "data": bytes_to_base64_str(data),
+        "prompt": prompt.decode("utf-8"),
+        "salt": bytes_to_base64_str(salt),
+    }
+
+
+def _entry_aad(index: int, count: int) -> bytes:
+    """Associated data of a version 2 record"""
+    return struct.pack(">QQ", index, count)
+
+
+def encrypt_deck_entries_v1(
+    entries: list[DeckEntry], encryption: DeckEncryptionSettings, key: bytes
 ) -> list[DeckEntry]:
-    """Encrypt deck entries. Does not mutate original list of entries.
+    """Encrypt deck entries into version 1 Fernet tokens.
+    Does not mutate original list of entries.
 
     This function follows the example from the cryptography library documentation
     https://cryptography.io/en/latest/fernet/#using-passwords-with-fernet
@@ -121,17 +461,15 @@ def encrypt_deck_entries(
         List of unencrypted deck entries
     encryption : DeckEncryptionSettings
         Deck encryption settings
-    password : str
-        Password
+    key : bytes
+        Key derived with :func:`derive_key`
 
     Returns
     -------
     list[DeckEntry]
         Encrypted deck entries
     """
-    salt = base64_str_to_bytes(encryption["salt"])
-    iterations = encryption["iterations"]
-    f = create_fernet(password, salt, iterations)
+    f = Fernet(base64.urlsafe_b64encode(key))
 
     encrypted_entries: list[DeckEntry] = []
     for i, entry in enumerate(entries):
@@ -152,10 +490,10 @@ def encrypt_deck_entries(
     return encrypted_entries
 
 
-def decrypt_deck_entries(
-    entries: list[DeckEntry], encryption: DeckEncryptionSettings, password: str
+def decrypt_deck_entries_v1(
+    entries: list[DeckEntry], encryption: DeckEncryptionSettings, key: bytes
 ) -> list[DeckEntry]:
-    """Decrypt deck entries.
+    """Decrypt version 1 deck entries.
 
     Parameters
     ----------
@@ -163,17 +501,15 @@ def decrypt_deck_entries(
         List of deck entries
     encryption : DeckEncryptionSettings
         Deck encryption settings
-    password : str
-        Password
+    key : bytes
+        Key derived with :func:`derive_key`
 
     Returns
     -------
     list[DeckEntry]
         List of enencrypted deck entries
     """
-    salt = base64.decodebytes(encryption["salt"].encode("ascii"))
-    iterations = encryption["iterations"]
-    f = create_fernet(password, salt, iterations)
+    f = Fernet(base64.urlsafe_b64encode(key))
 
     decrypted_entries: list[DeckEntry] = []
     for i, entry in enumerate(entries):
@@ -194,10 +530,8 @@ def decrypt_deck_entries(
     return decrypted_entries
 
 
-def create_fernet(password: str, salt: bytes, iterations: int) -> Fernet:
-    """Create a fernet instance.
-    Using https://cryptography.io/en/latest/fernet/#using-passwords-with-fernet
-    as reference
+def derive_key(password: str, salt: bytes, iterations: int) -> bytes:
+    """Derive a 32 byte key from the password with PBKDF2HMAC and SHA256.
 
     Parameters
     ----------
@@ -210,8 +544,8 @@ def create_fernet(password: str, salt: bytes, iterations: int) -> Fernet:
 
     Returns
     -------
-    Fernet
-        Fernet instance
+    bytes
+        Derived key
     """
     l.debug(
         "Setup kdf with PBKDF2HMAC, SHA256, length=%s, salt=%s, iterations=%s",
@@ -224,9 +558,7 @@ def create_fernet(password: str, salt: bytes, iterations: int) -> Fernet:
     )
 
     l.info("Derive key from password")
-    key = base64.urlsafe_b64encode(kdf.derive(bytes(password, "utf-8")))
-    f = Fernet(key)
-    return f
+    return kdf.derive(bytes(password, "utf-8"))
 
 
 def generate_deck_encryption_settings(enabled=True) -> DeckEncryptionSettings:
@@ -234,4 +566,5 @@ def generate_deck_encryption_settings(enabled=True) -> DeckEncryptionSettings:
         "salt": bytes_to_base64_str(os.urandom(32)),
         "iterations": 480000,
         "enabled": enabled,
+        "version": DECK_ENCRYPTION_VERSION,
     }
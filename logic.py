@@ -1,13 +1,26 @@
 import base64
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from hashlib import scrypt
+import os
 import secrets
 import logging
+from typing import Callable, Optional, TypedDict
 
 from deck import DeckContext, DeckEntry
-from settings import HashingSettings
+from settings import HashingSettings, IdentifySettings
 
 l = logging.getLogger(__name__)
 
+DEFAULT_IDENTIFY_MEMORY_LIMIT = 256 * 1024 * 1024
+"""Default upper bound (in bytes) of memory used by concurrent hashes"""
+
+
+class IdentifyMatch(TypedDict):
+    deck_name: str
+    index: int
+    """Index of the matching entry in its deck"""
+    prompt: str
+
 
 def create_training_entry(prompt: str, password: str, deck: DeckContext) -> DeckEntry:
     entries = deck.get_entries()
@@ -42,3 +55,117 @@ def hash_password(password: str, hash_settings: HashingSettings, salt: bytes) ->
     return scrypt(
         bytes(password, encoding="utf-8"), salt=salt, **hash_settings["arguments"]
     )
+
+
+def estimate_hash_memory(hash_settings: HashingSettings) -> int:
+    """Estimate the memory (in bytes) needed by a single :func:`hash_password` call.
+
+    Parameters
+    ----------
+    hash_settings : HashingSettings
+        Hashing settings
+
+    Returns
+    -------
+    int
+        Approximate number of bytes scrypt allocates for one hash
+    """
+    arguments = hash_settings["arguments"]
+    n = int(arguments.get("n", 2**14))
+    r = int(arguments.get("r", 8))
+    p = int(arguments.get("p", 1))
+    return 128 * r * (n + p)
+
+
+def identify_password(
+    password: str,
+    decks: list[DeckContext],
+    find_all: bool = False,
+    identify_settings: Optional[IdentifySettings] = None,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> list[IdentifyMatch]:
+    """Find the entries of the given decks that `password` belongs to.
+
+    Every entry has its own salt, so one hash is needed per entry. The hashes
+    run on a thread pool (scrypt releases the GIL), with the number of workers
+    capped so the concurrent hashes stay within the memory limit.
+
+    Parameters
+    ----------
+    password : str
+        Password to look for
+    decks : list[DeckContext]
+        Decks to search (already decrypted)
+    find_all : bool, optional
+        If True, scan every entry (reuse audit),
+        otherwise stop at the first match, by default False
+    identify_settings : Optional[IdentifySettings], optional
+        Worker count and memory limit, by default None
+    on_progress : Optional[Callable[[int, int], None]], optional
+        Called with the number of checked entries and the total, by default None
+
+    Returns
+    -------
+    list[IdentifyMatch]
+        Matching entries, in deck and entry order
+    """
+    identify_settings = identify_settings or {}
+    memory_limit = identify_settings.get("memory_limit", DEFAULT_IDENTIFY_MEMORY_LIMIT)
+
+    jobs: list[tuple[DeckContext, int, DeckEntry]] = []
+    for deck in decks:
+        for i, entry in enumerate(deck.get_entries()):
+            jobs.append((deck, i, entry))
+    total = len(jobs)
+    if total == 0:
+        return []
+
+    hash_memory = max(estimate_hash_memory(deck.get_hashing()) for deck in decks)
+    max_workers = identify_settings.get("max_workers") or os.cpu_count() or 1
+    max_workers = max(1, min(max_workers, memory_limit // hash_memory, total))
+    l.info(
+        "Identify password against %s entries with %s workers (find_all=%s)",
+        total,
+        max_workers,
+        find_all,
+    )
+
+    def check(job: tuple[DeckContext, int, DeckEntry]) -> bool:
+        deck, _, entry = job
+        salt = base64.decodebytes(entry["salt"].encode("ascii"))
+        correct_hash = base64.decodebytes(entry["data"].encode("ascii"))
+        return hash_password(password, deck.get_hashing(), salt) == correct_hash
+
+    matches: list[IdentifyMatch] = []
+    done_count = 0
+    next_job = 0
+    pending: dict[Future, tuple[DeckContext, int, DeckEntry]] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Keep at most `max_workers` hashes in flight, so an early exit
+        # does not leave a long queue of hashes to cancel.
+        while pending or next_job < total:
+            while next_job < total and len(pending) < max_workers:
+                job = jobs[next_job]
+                pending[executor.submit(check, job)] = job
+                next_job += 1
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                deck, i, entry = pending.pop(future)
+                done_count += 1
+                if future.result():
+                    l.info("Password matches entry %s of deck `%s`", i, deck.name)
+                    matches.append(
+                        {"deck_name": deck.name, "index": i, "prompt": entry["prompt"]}
+                    )
+            if on_progress:
+                on_progress(done_count, total)
+
+            if matches and not find_all:
+                for future in pending:
+                    future.cancel()
+                break
+
+    order = {deck.name: i for i, deck in enumerate(decks)}
+    matches.sort(key=lambda m: (order[m["deck_name"]], m["index"]))
+    return matches
@@ -1,6 +1,7 @@
 import logging
 
 from app import AppContext
+from deck import UnsupportedDeckVersionError
 from ui.browser import PageBrowser
 from ui.pages import main_page
 from utils import InvalidJsonFileError
@@ -25,6 +26,10 @@ def main():
         print(e)
         print("The invalid JSON file: {}".format(e.path))
         return
+    except UnsupportedDeckVersionError as e:
+        l.error("Tried loading a deck with an unsupported format", exc_info=1)
+        print(e)
+        return
     return
 
 
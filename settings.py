@@ -6,5 +6,13 @@ class HashingSettings(TypedDict):
     arguments: dict[str, int | str]
 
 
+class IdentifySettings(TypedDict, total=False):
+    max_workers: int
+    """Maximum number of concurrent hashes, defaults to the CPU count"""
+    memory_limit: int
+    """Upper bound (in bytes) of memory used by concurrent hashes"""
+
+
 class Settings(TypedDict):
     hashing: HashingSettings
+    identify: IdentifySettings
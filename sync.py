@@ -0,0 +1,478 @@
+"""Incremental sync between two deck directories.
+
+Each directory keeps a manifest (:data:`SYNC_MANIFEST_NAME`) with a random
+directory ID, the content hash of every deck and the state of each deck at
+the last sync with each peer directory. Decks whose size and modification
+time did not change are not read again, so a sync only does work
+proportional to the changed decks.
+
+- A deck changed on one side only is copied to the other side.
+- A deck changed on both sides is merged entry by entry. Encrypted decks can
+  only be merged if the key agent holds the key of either side, and both sides
+  use the same salt and iterations or the agent holds both keys.
+- Decks with conflicting entries, or that cannot be read or decrypted,
+  are reported and left untouched.
+
+Files are replaced atomically, so an interrupted sync never leaves a
+truncated deck or manifest behind. Deleted decks and entries are not
+propagated.
+
+Usage::
+
+    python sync.py LOCAL_DIR OTHER_DIR
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import os
+import shutil
+import uuid
+from typing import Optional, TypedDict
+
+from app import DECK_FILE_SUFFIX
+from deck import (
+    DeckContext,
+    DeckData,
+    DeckDecryptionError,
+    DeckEntry,
+    UnsupportedDeckVersionError,
+    request_agent_deck_key,
+)
+from utils import (
+    InvalidJsonFileError,
+    atomic_replace,
+    read_json_file,
+    write_json_to_file_atomic,
+)
+
+SYNC_MANIFEST_NAME = ".sync.json"
+"""Name of the manifest file in each synced deck directory"""
+
+_ENTRY_HASH_LABEL = b"password-trainer sync entry hash"
+
+l = logging.getLogger(__name__)
+
+
+class DeckFileState(TypedDict):
+    mtime_ns: int
+    size: int
+    hash: str
+
+
+class DeckSyncBase(TypedDict):
+    hash: str
+    """Content hash of this side's deck at the last sync"""
+    entries: Optional[dict[str, str]]
+    """Entry hashes by entry key at the last sync, if known.
+    For encrypted decks, keys and hashes are HMACs under the deck key,
+    so the plaintext manifest does not reveal the prompts.
+    """
+
+
+class SyncManifest(TypedDict):
+    id: str
+    """Random ID of the directory, so replicas at the same path
+    (or a volume mounted at different paths) are told apart
+    """
+    decks: dict[str, DeckFileState]
+    peers: dict[str, dict[str, DeckSyncBase]]
+    """Sync bases of each deck, by ID of the peer directory"""
+
+
+class SyncResult(TypedDict):
+    copied_to_local: list[str]
+    copied_to_other: list[str]
+    merged: list[str]
+    conflicts: list[str]
+    unchanged: list[str]
+
+
+class SyncConflictError(Exception):
+    pass
+
+
+class DeckDirectory:
+    """Deck directory with its sync manifest"""
+
+    path: str
+    manifest: SyncManifest
+
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        manifest_path = self.get_manifest_path()
+        self.manifest = {"decks": {}, "peers": {}}
+        if os.path.isfile(manifest_path):
+            self.manifest.update(read_json_file(manifest_path, {}))
+        if "id" not in self.manifest:
+            self.manifest["id"] = uuid.uuid4().hex
+            l.info("Assign ID `%s` to `%s`", self.manifest["id"], self.path)
+
+    def get_manifest_path(self) -> str:
+        return os.path.join(self.path, SYNC_MANIFEST_NAME)
+
+    def get_deck_path(self, name: str) -> str:
+        return os.path.join(self.path, name + DECK_FILE_SUFFIX)
+
+    def list_deck_names(self) -> set[str]:
+        return {
+            filename[: -len(DECK_FILE_SUFFIX)]
+            for filename in os.listdir(self.path)
+            if filename.endswith(DECK_FILE_SUFFIX)
+        }
+
+    def get_deck_hash(self, name: str) -> str:
+        """Get the content hash of a deck.
+        The file is only read if its size or modification time changed.
+        """
+        stat = os.stat(self.get_deck_path(name))
+        state = self.manifest["decks"].get(name)
+        if (
+            state
+            and state["mtime_ns"] == stat.st_mtime_ns
+            and state["size"] == stat.st_size
+        ):
+            return state["hash"]
+
+        l.debug("Hash deck `%s` in `%s`", name, self.path)
+        with open(self.get_deck_path(name), "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        self.manifest["decks"][name] = {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "hash": digest,
+        }
+        return digest
+
+    def get_sync_base(self, peer: "DeckDirectory", name: str) -> Optional[DeckSyncBase]:
+        return self.manifest["peers"].get(peer.manifest["id"], {}).get(name)
+
+    def set_sync_base(self, peer: "DeckDirectory", name: str, base: DeckSyncBase):
+        self.manifest["peers"].setdefault(peer.manifest["id"], {})[name] = base
+
+    def read_deck_data(self, name: str) -> DeckData:
+        """
+        Raises
+        ------
+        SyncConflictError
+            If the deck file is not valid JSON
+        """
+        try:
+            return read_json_file(self.get_deck_path(name))
+        except InvalidJsonFileError as e:
+            raise SyncConflictError(str(e))
+
+    def load_deck(
+        self, name: str, deck_data: DeckData, key: Optional[bytes] = None
+    ) -> DeckContext:
+        """Load a deck. If it is encrypted and no key is given,
+        the key is requested from the key agent.
+
+        Raises
+        ------
+        SyncConflictError
+            If the deck is encrypted and cannot be decrypted
+        """
+        path = self.get_deck_path(name)
+        try:
+            return DeckContext(name, deck_data, None, path, key)
+        except ValueError:
+            raise SyncConflictError(
+                "Deck `{}` is encrypted and its key is not in the agent".format(path)
+            )
+        except (DeckDecryptionError, UnsupportedDeckVersionError) as e:
+            raise SyncConflictError(str(e))
+        except KeyError as e:
+            raise SyncConflictError("Deck `{}` is missing {}".format(path, e))
+
+    def save_deck(self, deck: DeckContext):
+        write_json_to_file_atomic(
+            self.get_deck_path(deck.name), deck.generate_deck_data()
+        )
+
+    def save_manifest(self):
+        write_json_to_file_atomic(self.get_manifest_path(), self.manifest)
+
+
+def sync_deck_directories(local_path: str, other_path: str) -> SyncResult:
+    """Sync the decks of two deck directories in both directions.
+
+    Parameters
+    ----------
+    local_path : str
+        Path of the first deck directory
+    other_path : str
+        Path of the second deck directory (e.g. on a mounted backup volume)
+
+    Returns
+    -------
+    SyncResult
+        Names of the decks by what happened to them
+    """
+    local = DeckDirectory(local_path)
+    other = DeckDirectory(other_path)
+    result: SyncResult = {
+        "copied_to_local": [],
+        "copied_to_other": [],
+        "merged": [],
+        "conflicts": [],
+        "unchanged": [],
+    }
+
+    local_names = local.list_deck_names()
+    other_names = other.list_deck_names()
+    try:
+        for name in sorted(local_names | other_names):
+            _sync_deck(local, other, name, local_names, other_names, result)
+    finally:
+        # Keep the state of the decks synced so far, even if a deck failed
+        local.save_manifest()
+        other.save_manifest()
+    return result
+
+
+def _sync_deck(
+    local: DeckDirectory,
+    other: DeckDirectory,
+    name: str,
+    local_names: set[str],
+    other_names: set[str],
+    result: SyncResult,
+):
+    if name not in other_names:
+        _copy_deck(local, other, name)
+        result["copied_to_other"].append(name)
+        return
+    if name not in local_names:
+        _copy_deck(other, local, name)
+        result["copied_to_local"].append(name)
+        return
+
+    local_hash = local.get_deck_hash(name)
+    other_hash = other.get_deck_hash(name)
+    local_base = local.get_sync_base(other, name)
+    other_base = other.get_sync_base(local, name)
+    local_changed = local_base is None or local_base["hash"] != local_hash
+    other_changed = other_base is None or other_base["hash"] != other_hash
+    if local_hash == other_hash:
+        if local_changed or other_changed:
+            entries = None if local_changed else local_base["entries"]
+            _set_sync_base(local, other, name, local_hash, entries)
+        result["unchanged"].append(name)
+    elif not local_changed and not other_changed:
+        # Merged decks are encrypted separately on each side, so their files differ
+        result["unchanged"].append(name)
+    elif not local_changed:
+        _copy_deck(other, local, name)
+        result["copied_to_local"].append(name)
+    elif not other_changed:
+        _copy_deck(local, other, name)
+        result["copied_to_other"].append(name)
+    else:
+        try:
+            _merge_deck(local, other, name, local_base)
+            result["merged"].append(name)
+        except SyncConflictError as e:
+            l.warning("Conflict in deck `%s`: %s", name, e)
+            result["conflicts"].append(name)
+
+
+def _copy_deck(source: DeckDirectory, dest: DeckDirectory, name: str):
+    l.info("Copy deck `%s` from `%s` to `%s`", name, source.path, dest.path)
+    digest = source.get_deck_hash(name)
+    dest_path = dest.get_deck_path(name)
+    with atomic_replace(dest_path) as tmp_path:
+        shutil.copy2(source.get_deck_path(name), tmp_path)
+    stat = os.stat(dest_path)
+    dest.manifest["decks"][name] = {
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "hash": digest,
+    }
+
+    base = source.get_sync_base(dest, name)
+    entries = base["entries"] if base and base["hash"] == digest else None
+    _set_sync_base(source, dest, name, digest, entries)
+
+
+def _merge_deck(
+    local: DeckDirectory,
+    other: DeckDirectory,
+    name: str,
+    base: Optional[DeckSyncBase],
+):
+    """Merge the entries of a deck changed on both sides, and write the result
+    to both sides (each keeping its own encryption settings).
+
+    Raises
+    ------
+    SyncConflictError
+        If the deck cannot be decrypted, the hashing settings differ,
+        or both sides changed the same entry
+    """
+    l.info("Merge deck `%s` of `%s` and `%s`", name, local.path, other.path)
+    local_data = local.read_deck_data(name)
+    other_data = other.read_deck_data(name)
+    key = _find_shared_key(local, other, name, local_data, other_data)
+    local_deck = local.load_deck(name, local_data, key)
+    other_deck = other.load_deck(name, other_data, key)
+    if local_deck.get_hashing() != other_deck.get_hashing():
+        raise SyncConflictError("Hashing settings differ")
+
+    local_key = local_deck.get_key()
+    other_key = other_deck.get_key()
+    secret = _entry_hash_secret(local_key)
+    base_entries = (base or {}).get("entries") or {}
+    local_entries = _key_entries(local_deck.get_entries(), secret)
+    other_entries = _key_entries(other_deck.get_entries(), secret)
+
+    merged: dict[str, DeckEntry] = {}
+    for key, local_entry in local_entries.items():
+        other_entry = other_entries.get(key)
+        if other_entry is None:
+            merged[key] = local_entry
+            continue
+        local_hash = hash_deck_entry(local_entry, secret)
+        other_hash = hash_deck_entry(other_entry, secret)
+        if local_hash == other_hash or base_entries.get(key) == other_hash:
+            merged[key] = local_entry
+        elif base_entries.get(key) == local_hash:
+            merged[key] = other_entry
+        else:
+            raise SyncConflictError("Entry `{}` changed on both sides".format(key))
+    for key, other_entry in other_entries.items():
+        merged.setdefault(key, other_entry)
+
+    entries = list(merged.values())
+    for directory, deck in ((local, local_deck), (other, other_deck)):
+        deck.set_entries(entries)
+        directory.save_deck(deck)
+        directory.manifest["decks"].pop(name, None)
+
+    # Entry hashes are only kept if both sides can compute them the same way,
+    # and hashes of an encrypted deck must not be stored unkeyed on either side
+    entry_hashes = None
+    if local_key == other_key:
+        entry_hashes = {key: hash_deck_entry(e, secret) for key, e in merged.items()}
+
+    # Each side is encrypted separately, so the files can differ
+    local.set_sync_base(
+        other, name, {"hash": local.get_deck_hash(name), "entries": entry_hashes}
+    )
+    other.set_sync_base(
+        local, name, {"hash": other.get_deck_hash(name), "entries": entry_hashes}
+    )
+
+
+def _find_shared_key(
+    local: DeckDirectory,
+    other: DeckDirectory,
+    name: str,
+    local_data: DeckData,
+    other_data: DeckData,
+) -> Optional[bytes]:
+    """Get the key of a deck encrypted with the same salt and iterations on both
+    sides from the key agent, which may only hold it for one of the two paths.
+    """
+    local_encryption = local_data.get("encryption")
+    other_encryption = other_data.get("encryption")
+    if not (local_encryption and other_encryption):
+        return None
+    if not (local_encryption["enabled"] and other_encryption["enabled"]):
+        return None
+    if (local_encryption["salt"], local_encryption["iterations"]) != (
+        other_encryption["salt"],
+        other_encryption["iterations"],
+    ):
+        return None
+    return request_agent_deck_key(
+        local.get_deck_path(name), local_encryption
+    ) or request_agent_deck_key(other.get_deck_path(name), other_encryption)
+
+
+def _set_sync_base(
+    source: DeckDirectory,
+    dest: DeckDirectory,
+    name: str,
+    digest: str,
+    entries: Optional[dict[str, str]],
+):
+    """Record the sync base of a deck that is identical on both sides"""
+    source.set_sync_base(dest, name, {"hash": digest, "entries": entries})
+    dest.set_sync_base(source, name, {"hash": digest, "entries": entries})
+
+
+def _entry_hash_secret(deck_key: Optional[bytes]) -> Optional[bytes]:
+    """Derive the HMAC key for entry hashes from the deck key,
+    so the deck key itself is not used for a second purpose.
+    """
+    if deck_key is None:
+        return None
+    return hmac.digest(deck_key, _ENTRY_HASH_LABEL, "sha256")
+
+
+def _hash(data: bytes, secret: Optional[bytes]) -> str:
+    if secret is None:
+        return hashlib.sha256(data).hexdigest()
+    return hmac.new(secret, data, "sha256").hexdigest()
+
+
+def _key_entries(
+    entries: list[DeckEntry], secret: Optional[bytes] = None
+) -> dict[str, DeckEntry]:
+    """Key entries by a hash of their prompt (an HMAC if `secret` is given).
+    Repeated prompts are told apart by their occurrence.
+    """
+    keyed: dict[str, DeckEntry] = {}
+    counts: dict[str, int] = {}
+    for entry in entries:
+        prompt_hash = _hash(entry["prompt"].encode("utf-8"), secret)
+        n = counts.get(prompt_hash, 0)
+        counts[prompt_hash] = n + 1
+        keyed["{}:{}".format(prompt_hash, n)] = entry
+    return keyed
+
+
+def hash_deck_entry(entry: DeckEntry, secret: Optional[bytes] = None) -> str:
+    """Get the content hash of an unencrypted deck entry.
+
+    Parameters
+    ----------
+    entry : DeckEntry
+        Deck entry
+    secret : Optional[bytes], optional
+        HMAC key, for entries of encrypted decks, by default None
+
+    Returns
+    -------
+    str
+        SHA256 hash (or HMAC-SHA256) of the entry in hex
+    """
+    data = json.dumps(entry, sort_keys=True, separators=(",", ":"))
+    return _hash(data.encode("utf-8"), secret)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync two deck directories")
+    parser.add_argument("local_dir")
+    parser.add_argument("other_dir")
+    args = parser.parse_args()
+
+    result = sync_deck_directories(args.local_dir, args.other_dir)
+    for label, key in (
+        ("Copied to local", "copied_to_local"),
+        ("Copied to other", "copied_to_other"),
+        ("Merged", "merged"),
+        ("Conflicts", "conflicts"),
+    ):
+        for name in result[key]:
+            print("{}: {}".format(label, name))
+    print("{} decks unchanged".format(len(result["unchanged"])))
+    if result["conflicts"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
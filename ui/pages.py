@@ -3,8 +3,15 @@ import logging
 from getpass import getpass
 
 from app import AppContext, read_json_file
-from deck import DeckContext, DeckData, generate_deck_encryption_settings
-from logic import create_training_entry, hash_password
+from deck import (
+    DeckContext,
+    DeckData,
+    DeckDecryptionError,
+    DeckInfo,
+    generate_deck_encryption_settings,
+    request_agent_deck_key,
+)
+from logic import create_training_entry, hash_password, identify_password
 from ui.browser import RouteInfo
 
 from .helpers import print_heading, prompt_input, prompt_password, prompt_selection
@@ -21,7 +28,8 @@ def main_page(ctx: AppContext) -> RouteInfo:
     if deck_ctx is None:
         return {"next_page": deck_selection_page}
     i = prompt_selection(
-        ["Start Training", "Manage Passwords", "Exit"], "PASSWORD TRAINER"
+        ["Start Training", "Manage Passwords", "Identify Password", "Exit"],
+        "PASSWORD TRAINER",
     )
     match i:
         case 0:
@@ -29,6 +37,8 @@ def main_page(ctx: AppContext) -> RouteInfo:
         case 1:
             return {"next_page": password_manager_page}
         case 2:
+            return {"next_page": identify_page}
+        case 3:
             return {"exit": True}
     return {}
 
@@ -73,11 +83,32 @@ def deck_selection_page(ctx: AppContext) -> RouteInfo:
     deck_data: DeckData = read_json_file(deck_info["path"])
 
     password: str | None = None
+    key: bytes | None = None
     if deck_data["encryption"]["enabled"]:
-        password = prompt_password("Enter deck password", False)
+        key = request_agent_deck_key(deck_info["path"], deck_data["encryption"])
+        if key is None:
+            password = prompt_password("Enter deck password", False)
 
-    deck = DeckContext(deck_info["name"], deck_data, password)
+    deck = DeckContext(deck_info["name"], deck_data, password, deck_info["path"], key)
     ctx.load_deck(deck)
+
+    if deck.is_encryption_outdated():
+        s = prompt_selection(
+            ["Upgrade (recommended)", "Keep Current Format"],
+            "Deck Encryption Upgrade",
+            "This deck uses an older encryption format",
+        )
+        if s == 0:
+            while True:
+                if password is None:
+                    password = prompt_password("Enter deck password", False)
+                try:
+                    deck.upgrade_encryption(password)
+                    break
+                except DeckDecryptionError:
+                    print("Wrong password. Try again.\n")
+                    password = None
+            ctx.save_deck()
     return {"steps_back": 1}
 
 
@@ -102,6 +133,57 @@ def training_page(ctx: AppContext) -> RouteInfo:
     return {"steps_back": 1}
 
 
+def identify_page(ctx: AppContext) -> RouteInfo:
+    i = prompt_selection(
+        ["Search Current Deck", "Audit All Decks", "Back"],
+        "Identify Password",
+        "Find which entries a password belongs to",
+    )
+    match i:
+        case 0:
+            decks = [ctx.get_current_deck_context()]
+            find_all = False
+        case 1:
+            decks = ctx.load_all_deck_contexts(prompt_deck_password, print_skipped_deck)
+            find_all = True
+        case _:
+            return {"steps_back": 1}
+
+    password = prompt_password("Enter password to identify", False)
+    print()
+
+    def print_progress(done: int, total: int):
+        print("\rChecked {}/{} entries".format(done, total), end="", flush=True)
+
+    matches = identify_password(
+        password, decks, find_all, ctx.get_settings().get("identify"), print_progress
+    )
+    print("\n")
+
+    if len(matches) == 0:
+        print("The password does not match any entry.\n")
+    for match in matches:
+        print("Matches `{}` in deck `{}`".format(match["prompt"], match["deck_name"]))
+    if matches:
+        print()
+    return {}
+
+
+def prompt_deck_password(deck_info: DeckInfo, is_retry: bool) -> str | None:
+    if is_retry:
+        print("Wrong password for deck `{}`.\n".format(deck_info["name"]))
+    password = prompt_password(
+        "Enter password of deck `{}` (leave empty to skip)".format(deck_info["name"]),
+        False,
+    )
+    print()
+    return password or None
+
+
+def print_skipped_deck(deck_info: DeckInfo, error: Exception):
+    print("Skipped deck `{}`: {}\n".format(deck_info["name"], error))
+
+
 def password_manager_page(ctx: AppContext) -> RouteInfo:
     i = prompt_selection(
         ["Add Password Entry", "Back"],
@@ -2,7 +2,9 @@ import logging
 import base64
 import json
 import os
-from typing import Optional
+import tempfile
+from contextlib import contextmanager
+from typing import Iterator, Optional
 
 
 l = logging.getLogger(__name__)
@@ -48,3 +50,34 @@ def write_json_to_file(path: str, data: any):
     with open(path, "w") as f:
         json.dump(data, f, indent=4)
     return data
+
+
+@contextmanager
+def atomic_replace(path: str) -> Iterator[str]:
+    """Write a file through a temporary file in the same directory,
+    which replaces `path` only once it is completely written.
+    An interrupted write never leaves a truncated file at `path`.
+
+    Yields
+    ------
+    str
+        Path of the temporary file to write to
+    """
+    directory, filename = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix="." + filename + ".", dir=directory)
+    os.close(fd)
+    try:
+        yield tmp_path
+        with open(tmp_path, "rb+") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def write_json_to_file_atomic(path: str, data: any):
+    """Like :func:`write_json_to_file`, but through :func:`atomic_replace`"""
+    with atomic_replace(path) as tmp_path:
+        write_json_to_file(tmp_path, data)
+    return data